@@ -1,22 +1,27 @@
 __version__ = "0.1.0"
 
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from . import api
 
-app = FastAPI(title="HippoDB", version=__version__, lifespan=api.hippo_lifespan)
+app = FastAPI(
+    title="HippoDB",
+    version=__version__,
+    lifespan=api.hippo_lifespan,
+    default_response_class=ORJSONResponse,
+)
 app.include_router(api.router)
 app.include_router(api.application)
 
-templates = Jinja2Templates(directory="templates")
-
-
-@app.get("/", response_class=HTMLResponse)
-def root():
-    return """<html lang="en">
+_ROOT_HTML = """<html lang="en">
     <head>
         <title>Home — HippoDB</title>
     </head>
     <body>Hello, world!</body>
-</html>"""
+</html>""".encode()
+_ROOT_HEADERS = {"cache-control": "public, max-age=3600"}
+
+
+@app.get("/", response_class=HTMLResponse)
+def root():
+    return HTMLResponse(content=_ROOT_HTML, headers=_ROOT_HEADERS)
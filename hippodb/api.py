@@ -1,3 +1,6 @@
+import asyncio
+import hmac
+import logging
 from contextlib import asynccontextmanager
 from http.client import FORBIDDEN, UNAUTHORIZED
 from typing import Any
@@ -6,13 +9,16 @@ from urllib.parse import unquote
 from typing_extensions import Annotated, TypedDict, cast
 import orjson
 from pydantic import BaseModel
-from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
-from hippodb.hippo import HippoDB, Token
+from hippodb.hippo import ApplicationView, HippoDB
 from . import __version__
 
 
+logger = logging.getLogger(__name__)
+
 HIPPODB = cast(HippoDB, None)
 
 
@@ -21,13 +27,29 @@ async def hippo_lifespan(_app: FastAPI):
     global HIPPODB
     HIPPODB = HippoDB()
 
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(0.1)
+
+            if not HIPPODB._dirty:
+                continue
+
+            try:
+                await HIPPODB.submit_write(HIPPODB.flush)
+
+            except Exception:
+                logger.exception("Failed to flush HippoDB maps")
+
+    flusher = asyncio.create_task(flush_periodically())
+
     yield
 
+    flusher.cancel()
     HIPPODB.cleanup()
     HIPPODB = cast(HippoDB, None)
 
 
-router = APIRouter(prefix="/api")
+router = APIRouter(prefix="/api", default_response_class=ORJSONResponse)
 
 
 ServerInfo = TypedDict(
@@ -36,7 +58,7 @@ ServerInfo = TypedDict(
 
 
 @router.get("/")
-def server_info() -> ServerInfo:
+async def server_info() -> ServerInfo:
     return {
         "version": __version__,
         "features": [],
@@ -46,33 +68,27 @@ def server_info() -> ServerInfo:
     }
 
 
-class ApplicationView:
-    def __init__(self, token: Token):
-        self.app_id = token.application
-        self.writable = token.writeable
-
-
 http_security = HTTPBasic()
 
 
-def application_dependency(
+async def application_dependency(
     credentials: Annotated[HTTPBasicCredentials, Depends(http_security)]
 ):
-    if credentials.username not in HIPPODB.applications.keys():
-        raise HTTPException(UNAUTHORIZED, "Application does not exist.")
+    view = HIPPODB.views.get(credentials.password)
 
-    if credentials.password not in HIPPODB.tokens.keys():
-        raise HTTPException(UNAUTHORIZED, "Invalid token.")
+    if (
+        view is None
+        or view.app_id not in HIPPODB.applications
+        or not hmac.compare_digest(view.app_id.encode(), credentials.username.encode())
+    ):
+        raise HTTPException(UNAUTHORIZED, "Invalid application or token.")
 
-    if HIPPODB.tokens[credentials.password].application != credentials.username:
-        raise HTTPException(UNAUTHORIZED, "Token and application do not match.")
-
-    return ApplicationView(HIPPODB.tokens[credentials.password])
+    return view
 
 
 ApplicationDependency = Annotated[ApplicationView, Depends(application_dependency)]
 
-application = APIRouter(prefix="/api")
+application = APIRouter(prefix="/api", default_response_class=ORJSONResponse)
 
 
 class ApplicationInfo(BaseModel):
@@ -81,7 +97,7 @@ class ApplicationInfo(BaseModel):
 
 
 @application.get("/apps", tags=["application"])
-def list_apps() -> list[ApplicationInfo]:
+async def list_apps() -> list[ApplicationInfo]:
     return [
         ApplicationInfo(id=app.id, name=app.name)
         for app in HIPPODB.applications.values()
@@ -89,29 +105,29 @@ def list_apps() -> list[ApplicationInfo]:
 
 
 @application.post("/apps/new", tags=["application"])
-def new_application(name: str) -> ApplicationInfo:
-    app = HIPPODB.create_application(name)
+async def new_application(name: str) -> ApplicationInfo:
+    app = await HIPPODB.create_application(name)
 
     return ApplicationInfo(id=app.id, name=app.name)
 
 
 @application.delete("/apps/delete", tags=["application"])
-def delete_application(app_id: str, app_view: ApplicationDependency) -> None:
+async def delete_application(app_id: str, app_view: ApplicationDependency) -> None:
     if app_view.app_id != app_id:
         raise HTTPException(
             FORBIDDEN, "You do not have permission to delete this application."
         )
 
-    HIPPODB.delete_application(app_id)
+    await HIPPODB.delete_application(app_id)
 
 
 @application.post("/tokens/new", tags=["token"])
-def new_token(app_id: str, writeable: bool = False) -> str:
+async def new_token(app_id: str, writeable: bool = False) -> str:
     return HIPPODB.create_token(app_id, writeable).id
 
 
 @application.delete("/tokens/delete", tags=["token"])
-def delete_token(token_id: str, app_view: ApplicationDependency) -> None:
+async def delete_token(token_id: str, app_view: ApplicationDependency) -> None:
     if app_view.app_id != HIPPODB.tokens[token_id].application:
         raise HTTPException(
             FORBIDDEN, "You do not have permission to delete this token."
@@ -145,15 +161,17 @@ def process_db_name(name: str) -> str:
 
 
 @application.post("/create_db", tags=["database"])
-def new_database(app_view: ApplicationDependency, path: str) -> DatabaseInfo:
+async def new_database(app_view: ApplicationDependency, path: str) -> DatabaseInfo:
     if not path.startswith("/"):
         path = "/" + path
 
-    return DatabaseInfo(path=HIPPODB.create_database(app_view.app_id, path).path)
+    db = await HIPPODB.create_database(app_view.app_id, path)
+
+    return DatabaseInfo(path=db.path)
 
 
 @application.get("/dbs/{db_name}", tags=["database"])
-def list_databases(
+async def list_databases(
     app_view: ApplicationDependency, db_name: str = "/", recursive: bool = False
 ) -> list[DatabaseInfo]:
     """
@@ -162,21 +180,14 @@ def list_databases(
 
     db_name = process_db_name(db_name)
 
-    dbs = [
+    return [
         DatabaseInfo(path=db.path)
-        for db in HIPPODB.databases[app_view.app_id].values()
-        if db.path.startswith(db_name)
+        for db in HIPPODB.list_databases(app_view.app_id, db_name, recursive)
     ]
 
-    if not recursive:
-        query_length = len(db_name)
-        dbs = [db for db in dbs if db.path[query_length:].count("/") == 0]
-
-    return dbs
-
 
 @application.get("/{db_name}", tags=["database"])
-def list_documents(app_view: ApplicationDependency, db_name: str) -> list[str]:
+async def list_documents(app_view: ApplicationDependency, db_name: str) -> list[str]:
     """
     `db_name` must be url encoded twice to get around a deficiency in ASGI.
     """
@@ -185,7 +196,7 @@ def list_documents(app_view: ApplicationDependency, db_name: str) -> list[str]:
 
     return list(
         HIPPODB.documents[app_view.app_id][
-            HIPPODB.databases[app_view.app_id][db_name].id
+            HIPPODB.database_index[(app_view.app_id, db_name)].id
         ].keys()
     )
 
@@ -200,16 +211,14 @@ def list_documents(app_view: ApplicationDependency, db_name: str) -> list[str]:
 
 
 @application.delete("/{db_name}", tags=["database"])
-def delete_database(app_view: ApplicationDependency, db_name: str) -> None:
+async def delete_database(app_view: ApplicationDependency, db_name: str) -> None:
     """
     `db_name` must be url encoded twice to get around a deficiency in ASGI.
     """
 
     db_name = process_db_name(db_name)
 
-    HIPPODB.delete_database(
-        app_view.app_id, HIPPODB.databases[app_view.app_id][db_name].id
-    )
+    await HIPPODB.delete_database(app_view.app_id, db_name)
 
 
 ### Documents ###
@@ -228,39 +237,40 @@ async def new_document(
 
     db_name = process_db_name(db_name)
 
-    document_name = document_name or str(uuid4())
+    document_name = document_name or uuid4().hex
 
-    HIPPODB.update_document(
+    await HIPPODB.update_document(
         app_view.app_id,
-        HIPPODB.databases[app_view.app_id][db_name].id,
+        HIPPODB.database_index[(app_view.app_id, db_name)].id,
         document_name,
-        orjson.dumps(body).decode(),
+        orjson.dumps(body),
     )
 
     return document_name
 
 
 @application.get("/{db_name}/{document_name}", tags=["document"])
-def read_document(
+async def read_document(
     app_view: ApplicationDependency, db_name: str, document_name: str
-) -> list[Any] | dict[str, Any]:
+) -> Response:
     """
     `db_name` and `document_name` must be url encoded twice to get around a deficiency in ASGI.
     """
 
     db_name, document_name = process_db_name(db_name), unquote(document_name)
 
-    return orjson.loads(
-        HIPPODB.read_document(
+    return Response(
+        content=await HIPPODB.read_document(
             app_view.app_id,
-            HIPPODB.databases[app_view.app_id][db_name].id,
+            HIPPODB.database_index[(app_view.app_id, db_name)].id,
             document_name,
-        )
+        ),
+        media_type="application/json",
     )
 
 
 @application.get("/{db_name}/{document_name}/exists", tags=["document"])
-def document_exists(
+async def document_exists(
     app_view: ApplicationDependency, db_name: str, document_name: str
 ) -> bool:
     """
@@ -270,15 +280,14 @@ def document_exists(
     db_name, document_name = process_db_name(db_name), unquote(document_name)
 
     return (
-        document_name
-        in HIPPODB.documents[app_view.app_id][
-            HIPPODB.databases[app_view.app_id][db_name].id
-        ]
-    )
+        app_view.app_id,
+        HIPPODB.database_index[(app_view.app_id, db_name)].id,
+        document_name,
+    ) in HIPPODB.document_index
 
 
 @application.put("/{db_name}/{document_name}", tags=["document"])
-def update_document(
+async def update_document(
     app_view: ApplicationDependency,
     db_name: str,
     document_name: str,
@@ -290,28 +299,29 @@ def update_document(
 
     db_name, document_name = process_db_name(db_name), unquote(document_name)
 
-    HIPPODB.update_document(
+    await HIPPODB.update_document(
         app_view.app_id,
-        HIPPODB.databases[app_view.app_id][db_name].id,
+        HIPPODB.database_index[(app_view.app_id, db_name)].id,
         document_name,
-        orjson.dumps(body).decode(),
+        orjson.dumps(body),
     )
 
 
 @application.delete("/{db_name}/{document_name}", tags=["document"])
-def delete_document(
+async def delete_document(
     app_view: ApplicationDependency, db_name: str, document_name: str
-) -> list[Any] | dict[str, Any]:
+) -> Response:
     """
     `db_name` and `document_name` must be url encoded twice to get around a deficiency in ASGI.
     """
 
     db_name, document_name = process_db_name(db_name), unquote(document_name)
 
-    return orjson.loads(
-        HIPPODB.delete_document(
+    return Response(
+        content=await HIPPODB.delete_document(
             app_view.app_id,
-            HIPPODB.databases[app_view.app_id][db_name].id,
+            HIPPODB.database_index[(app_view.app_id, db_name)].id,
             document_name,
-        )
+        ),
+        media_type="application/json",
     )
@@ -1,40 +1,91 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from concurrent.futures import Future
 from dataclasses import dataclass
-from pprint import pprint
+import queue
 import shutil
+import threading
 from uuid import uuid4
 import os
 import pathlib
-from typing import Any, TypeVar, TypedDict, cast
-from dataclasses_json import DataClassJsonMixin
+from typing import Any, Callable, TypedDict, cast
+import anyio
+import msgspec
 import orjson
 
 
 @dataclass
-class Database(DataClassJsonMixin):
+class Database:
     id: str
     application: str
     path: str
 
 
 @dataclass
-class Application(DataClassJsonMixin):
+class Application:
     id: str
     name: str
 
 
 @dataclass
-class Token(DataClassJsonMixin):
+class Token:
     id: str
     application: str
     writeable: bool
 
 
+class ApplicationView:
+    def __init__(self, token: Token):
+        self.app_id = token.application
+        self.writable = token.writeable
+
+
 Applications = TypedDict(
     "Applications",
-    {"applications": list[dict[Any, Any]], "tokens": list[dict[Any, Any]]},
+    {"applications": list[Application], "tokens": list[Token]},
 )
 DBMap = dict[str, Database]
 DocumentMap = dict[str, str]
+WriteJob = tuple[Callable[..., Any], tuple[Any, ...], Future[Any]]
+
+
+def parent_path(path: str) -> str:
+    return path[: path.rfind("/") + 1]
+
+
+def write_atomic(path: pathlib.Path, data: bytes, sync: bool = False) -> None:
+    tmp = path.with_suffix(".tmp")
+
+    with open(tmp, "wb") as f:
+        f.write(data)
+
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.replace(tmp, path)
+
+
+def sync_dir(path: pathlib.Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+def make_dirs(path: pathlib.Path) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+
+
+def read_and_unlink(path: pathlib.Path) -> bytes:
+    contents = path.read_bytes()
+    path.unlink()
+
+    return contents
 
 
 class HippoDB:
@@ -42,86 +93,248 @@ class HippoDB:
         self.hippo_dir = pathlib.Path(os.environ.get("HIPPODB_DIR", "hippo_data"))
         self.applications: dict[str, Application] = {}
         self.tokens: dict[str, Token] = {}
+        self.views: dict[str, ApplicationView] = {}
         self.databases: dict[str, dict[str, Database]] = {}
         self.documents: dict[str, dict[str, DocumentMap]] = {}
+        self.database_index: dict[tuple[str, str], Database] = {}
+        self.database_children: dict[str, dict[str, DBMap]] = {}
+        self.database_paths: dict[str, list[str]] = {}
+        self.document_index: dict[tuple[str, str, str], str] = {}
+        self._dirty: set[tuple[str, ...]] = set()
+        self._writes: queue.Queue[WriteJob | None] = queue.Queue()
+        self._writer = threading.Thread(target=self.process_writes, daemon=True)
+        self._creating: dict[tuple[str, str, str], asyncio.Future[Any]] = {}
+        self.cache_bytes = int(os.environ.get("HIPPODB_CACHE_BYTES", 64 * 1024 * 1024))
+        self._document_cache: OrderedDict[tuple[str, str, str], bytes] = OrderedDict()
+        self._cached_bytes = 0
 
         self.load()
+        self._writer.start()
 
     def create_token(self, application: str, writeable: bool = False) -> Token:
-        token_id = str(uuid4())
+        token_id = uuid4().hex
 
         self.tokens[token_id] = Token(token_id, application, writeable)
-        self.save_applications_file()
+        self.views[token_id] = ApplicationView(self.tokens[token_id])
+        self._dirty.add(("applications",))
 
         return self.tokens[token_id]
 
-    def create_application(self, name: str) -> Application:
-        app_id = str(uuid4())
+    async def create_application(self, name: str) -> Application:
+        app_id = uuid4().hex
 
         self.applications[app_id] = Application(app_id, name)
         self.databases[app_id] = {}
         self.documents[app_id] = {}
-        self.save_applications_file()
-        self.create_database(app_id, "/")
+        self._dirty.add(("applications",))
+        await self.create_database(app_id, "/")
 
         return self.applications[app_id]
 
-    def create_database(self, application: str, path: str) -> Database:
-        db_id = str(uuid4())
+    async def create_database(self, application: str, path: str) -> Database:
+        if path in self.databases[application]:
+            return self.databases[application][path]
+
+        db_id = uuid4().hex
 
         self.databases[application][path] = Database(db_id, application, path)
+        self.index_database(self.databases[application][path])
         self.documents[application][db_id] = {}
-        self.save_db_map(application)
-        self.save_document_map(application, db_id)
+        self._dirty.add(("db_map", application))
+        self._dirty.add(("document_map", application, db_id))
+
+        await self.submit_write(make_dirs, self.hippo_dir / "db" / application / db_id)
 
         return self.databases[application][path]
 
-    def update_document(
-        self, application: str, database: str, document_name: str, contents: str
+    async def update_document(
+        self, application: str, database: str, document_name: str, contents: bytes
     ) -> None:
-        if document_name not in self.documents[application][database]:
-            document_id = str(uuid4())
-            self.documents[application][database][document_name] = document_id
-            self.save_document_map(application, database)
+        key = (application, database, document_name)
+
+        # Wait for any in-flight creation of this name so it is only created once.
+        while (creating := self._creating.get(key)) is not None:
+            await asyncio.wait([creating])
+
+        if (document_id := self.document_index.get(key)) is not None:
+            await self.submit_write(
+                write_atomic,
+                self.hippo_dir / "db" / application / database / document_id,
+                contents,
+            )
 
         else:
-            document_id = self.documents[application][database][document_name]
+            # The database was deleted while this call waited, and its rmtree
+            # is already queued, so the write would have nowhere to go.
+            if database not in self.documents.get(application, {}):
+                return
+
+            document_id = uuid4().hex
+            write = self.submit_write(
+                write_atomic,
+                self.hippo_dir / "db" / application / database / document_id,
+                contents,
+            )
+            self._creating[key] = write
 
-        (self.hippo_dir / "db" / application / database / document_id).write_text(
-            contents, encoding="utf-8"
-        )
+            # A new document is only indexed once its file is on disk, so a
+            # failed or cancelled write leaves no entry pointing at nothing.
+            try:
+                await write
 
-    def read_document(self, application: str, database: str, document_name: str) -> str:
-        document_id = self.documents[application][database][document_name]
+            finally:
+                del self._creating[key]
 
-        return (self.hippo_dir / "db" / application / database / document_id).read_text(
-            encoding="utf-8"
-        )
+            # The database was deleted while the write was queued; the rmtree
+            # queued behind it has removed the file again.
+            if database not in self.documents.get(application, {}):
+                return
 
-    def delete_document(
+            self.documents[application][database][document_name] = document_id
+            self.document_index[key] = document_id
+            self._dirty.add(("document_map", application, database))
+
+        # Skip caching if the document was deleted while the write was queued.
+        if self.document_index.get(key) == document_id:
+            self.cache_document(key, contents)
+
+    async def read_document(
         self, application: str, database: str, document_name: str
-    ) -> str:
-        document_id = self.documents[application][database][document_name]
-        document_file = self.hippo_dir / "db" / application / database / document_id
+    ) -> bytes:
+        key = (application, database, document_name)
+        document_id = self.document_index[key]
 
-        contents = document_file.read_text(encoding="utf-8")
+        if (cached := self._document_cache.get(key)) is not None:
+            self._document_cache.move_to_end(key)
+            return cached
 
-        document_file.unlink()
+        contents = await anyio.to_thread.run_sync(
+            (self.hippo_dir / "db" / application / database / document_id).read_bytes
+        )
 
-        self.save_document_map(application, database)
+        # Skip caching if the document was deleted while this read was in
+        # flight, or if a write that finished meanwhile cached newer contents.
+        if (
+            self.document_index.get(key) == document_id
+            and key not in self._document_cache
+        ):
+            self.cache_document(key, contents)
 
         return contents
 
-    def delete_database(self, application: str, database: str) -> None:
-        del self.databases[application][database]
-        del self.documents[application][database]
+    async def delete_document(
+        self, application: str, database: str, document_name: str
+    ) -> bytes:
+        key = (application, database, document_name)
+        document_id = self.document_index.pop(key)
+        del self.documents[application][database][document_name]
+        self.uncache_document(key)
+        self._dirty.add(("document_map", application, database))
+
+        return await self.submit_write(
+            read_and_unlink,
+            self.hippo_dir / "db" / application / database / document_id,
+        )
+
+    def submit_write(self, op: Callable[..., Any], *args: Any) -> asyncio.Future[Any]:
+        future: Future[Any] = Future()
+        self._writes.put((op, args, future))
+
+        return asyncio.wrap_future(future)
+
+    def process_writes(self) -> None:
+        while (job := self._writes.get()) is not None:
+            op, args, future = job
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(op(*args))
+
+            except Exception as e:
+                future.set_exception(e)
+
+    def cache_document(self, key: tuple[str, str, str], contents: bytes) -> None:
+        self.uncache_document(key)
+
+        if len(contents) > self.cache_bytes:
+            return
+
+        self._document_cache[key] = contents
+        self._cached_bytes += len(contents)
+
+        while self._cached_bytes > self.cache_bytes:
+            _, evicted = self._document_cache.popitem(last=False)
+            self._cached_bytes -= len(evicted)
 
-        shutil.rmtree(self.hippo_dir / "db" / application / database)
+    def uncache_document(self, key: tuple[str, str, str]) -> None:
+        if (contents := self._document_cache.pop(key, None)) is not None:
+            self._cached_bytes -= len(contents)
 
-        self.save_db_map(application)
+    def index_database(self, db: Database) -> None:
+        self.database_index[(db.application, db.path)] = db
+        self.database_children.setdefault(db.application, {}).setdefault(
+            parent_path(db.path), {}
+        )[db.path] = db
+        bisect.insort(self.database_paths.setdefault(db.application, []), db.path)
+
+    def unindex_database(self, db: Database) -> None:
+        del self.database_index[(db.application, db.path)]
+        del self.database_children[db.application][parent_path(db.path)][db.path]
+
+        paths = self.database_paths[db.application]
+        del paths[bisect.bisect_left(paths, db.path)]
+
+    def list_databases(
+        self, application: str, path: str, recursive: bool = False
+    ) -> list[Database]:
+        if not recursive:
+            return [
+                db
+                for db in self.database_children.get(application, {})
+                .get(parent_path(path), {})
+                .values()
+                if db.path.startswith(path)
+            ]
+
+        paths = self.database_paths.get(application, [])
+        dbs = []
+
+        for i in range(bisect.bisect_left(paths, path), len(paths)):
+            if not paths[i].startswith(path):
+                break
+
+            dbs.append(self.database_index[(application, paths[i])])
+
+        return dbs
+
+    async def delete_database(self, application: str, path: str) -> None:
+        db = self.databases[application].pop(path)
+        self.unindex_database(db)
+        database = db.id
+
+        for document_name in self.documents[application].pop(database):
+            del self.document_index[(application, database, document_name)]
+            self.uncache_document((application, database, document_name))
+
+        self._dirty.add(("db_map", application))
+
+        await self.submit_write(
+            shutil.rmtree, self.hippo_dir / "db" / application / database
+        )
+
+    async def delete_application(self, application: str) -> None:
+        for path, database in self.databases[application].items():
+            del self.database_index[(application, path)]
+
+            for document_name in self.documents[application][database.id]:
+                del self.document_index[(application, database.id, document_name)]
+                self.uncache_document((application, database.id, document_name))
 
-    def delete_application(self, application: str) -> None:
         del self.databases[application]
+        self.database_children.pop(application, None)
+        self.database_paths.pop(application, None)
         del self.documents[application]
         del self.applications[application]
 
@@ -133,13 +346,16 @@ class HippoDB:
 
         for token_id in tokens:
             del self.tokens[token_id]
+            del self.views[token_id]
 
-        shutil.rmtree(self.hippo_dir / "db" / application)
-        self.save_applications_file()
+        self._dirty.add(("applications",))
+
+        await self.submit_write(shutil.rmtree, self.hippo_dir / "db" / application)
 
     def delete_token(self, token: str) -> None:
         del self.tokens[token]
-        self.save_applications_file()
+        del self.views[token]
+        self._dirty.add(("applications",))
 
     def load(self) -> None:
         self.load_applications_file()
@@ -151,74 +367,72 @@ class HippoDB:
                 self.load_document_map(application, database.id)
 
     def load_applications_file(self) -> None:
-        if not self.hippo_dir.exists():
-            self.hippo_dir.mkdir(parents=True)
-
-        if not (self.hippo_dir / "applications.json").exists():
-            self.save_applications_file()
-            return
-
-        data = cast(
-            Applications,
-            orjson.loads((self.hippo_dir / "applications.json").read_text()),
-        )
+        migrate = False
 
-        T = TypeVar("T", Application, Token)
-
-        def load_field(t: type[T], field: str) -> dict[str, T]:
-            return dict(
-                [
-                    (value.id, value)
-                    for value in t.schema().load(
-                        data[field],
-                        many=True,
-                    )
-                ]
+        try:
+            data = msgspec.msgpack.decode(
+                (self.hippo_dir / "applications.mp").read_bytes(), type=Applications
             )
 
-        self.applications = load_field(Application, "applications")
-        self.tokens = load_field(Token, "tokens")
+        except FileNotFoundError:
+            try:
+                data = msgspec.json.decode(
+                    (self.hippo_dir / "applications.json").read_bytes(),
+                    type=Applications,
+                )
+                migrate = True
 
-    def load_db_map(self, application: str) -> None:
-        app_dir = self.hippo_dir / "db" / application
+            except FileNotFoundError:
+                self.hippo_dir.mkdir(parents=True, exist_ok=True)
+                self.save_applications_file()
+                return
 
-        if not app_dir.exists():
-            app_dir.mkdir(parents=True)
+        self.applications = {app.id: app for app in data["applications"]}
+        self.tokens = {token.id: token for token in data["tokens"]}
+        self.views = {
+            token_id: ApplicationView(token) for token_id, token in self.tokens.items()
+        }
 
-        db_map = app_dir / "map.json"
+        if migrate:
+            self.save_applications_file()
 
+    def load_db_map(self, application: str) -> None:
         self.databases.setdefault(application, {})
         self.documents.setdefault(application, {})
 
-        if not db_map.exists():
-            self.save_db_map(application)
+        try:
+            db_map = orjson.loads(
+                (self.hippo_dir / "db" / application / "map.json").read_bytes()
+            )
 
+        except FileNotFoundError:
+            self.save_db_map(application)
             return
 
-        for db in (
-            Database.schema().load(db)
-            for db in orjson.loads(db_map.read_text(encoding="utf-8")).values()
-        ):
+        for db in (Database(**db) for db in db_map.values()):
             self.databases[application][db.path] = db
+            self.index_database(db)
 
     def load_document_map(self, application: str, database: str) -> None:
-        db_dir = self.hippo_dir / "db" / application / database
-
-        if not db_dir.exists():
-            db_dir.mkdir(parents=True)
-
-        document_map = db_dir / "map.json"
-
         self.documents.setdefault(application, {})
 
-        if not document_map.exists():
+        try:
+            self.documents[application][database] = cast(
+                dict[str, str],
+                orjson.loads(
+                    (
+                        self.hippo_dir / "db" / application / database / "map.json"
+                    ).read_bytes()
+                ),
+            )
+
+        except FileNotFoundError:
             self.documents[application][database] = {}
             self.save_document_map(application, database)
             return
 
-        self.documents[application][database] = cast(
-            dict[str, str], orjson.loads(document_map.read_text(encoding="utf-8"))
-        )
+        for document_name, document_id in self.documents[application][database].items():
+            self.document_index[(application, database, document_name)] = document_id
 
     def save(self) -> None:
         if not self.hippo_dir.exists():
@@ -233,20 +447,17 @@ class HippoDB:
                 self.save_document_map(application, database.id)
 
     def save_applications_file(self) -> None:
-        (self.hippo_dir / "applications.json").write_bytes(
-            orjson.dumps(
+        write_atomic(
+            self.hippo_dir / "applications.mp",
+            msgspec.msgpack.encode(
                 Applications(
                     {
-                        "applications": [
-                            Application.schema().dump(app)
-                            for app in self.applications.values()
-                        ],
-                        "tokens": [
-                            Token.schema().dump(token) for token in self.tokens.values()
-                        ],
+                        "applications": list(self.applications.values()),
+                        "tokens": list(self.tokens.values()),
                     }
                 )
             ),
+            sync=True,
         )
 
     def save_db_map(self, application: str) -> None:
@@ -255,13 +466,15 @@ class HippoDB:
         if not app_dir.exists():
             app_dir.mkdir(parents=True)
 
-        (app_dir / "map.json").write_bytes(
+        write_atomic(
+            app_dir / "map.json",
             orjson.dumps(
-                dict(
-                    (db.id, Database.schema().dump(db))
-                    for db in self.databases[application].values()
-                )
-            )
+                {
+                    db.id: {"id": db.id, "application": db.application, "path": db.path}
+                    for db in list(self.databases[application].values())
+                }
+            ),
+            sync=True,
         )
 
     def save_document_map(self, application: str, database: str) -> None:
@@ -270,8 +483,56 @@ class HippoDB:
         if not db_dir.exists():
             db_dir.mkdir(parents=True)
 
-        (db_dir / "map.json").write_bytes(
-            orjson.dumps(self.documents[application][database])
+        write_atomic(
+            db_dir / "map.json",
+            orjson.dumps(self.documents[application][database]),
+            sync=True,
         )
 
-    def cleanup(self): ...
+    def flush(self) -> None:
+        saved_dirs: set[pathlib.Path] = set()
+
+        try:
+            for key in list(self._dirty):
+                self.flush_key(key, saved_dirs)
+
+        finally:
+            # One directory fsync per flush makes the renames above durable.
+            for directory in saved_dirs:
+                try:
+                    sync_dir(directory)
+
+                except FileNotFoundError:
+                    pass
+
+    def flush_key(self, key: tuple[str, ...], saved_dirs: set[pathlib.Path]) -> None:
+        # Discarded before saving so a change made mid-save marks the key dirty
+        # again, and restored if the save fails.
+        self._dirty.discard(key)
+
+        try:
+            match key:
+                case ("applications",):
+                    self.save_applications_file()
+                    saved_dirs.add(self.hippo_dir)
+
+                case ("db_map", application) if application in self.databases:
+                    self.save_db_map(application)
+                    saved_dirs.add(self.hippo_dir / "db" / application)
+
+                case (
+                    "document_map",
+                    application,
+                    database,
+                ) if database in self.documents.get(application, {}):
+                    self.save_document_map(application, database)
+                    saved_dirs.add(self.hippo_dir / "db" / application / database)
+
+        except Exception:
+            self._dirty.add(key)
+            raise
+
+    def cleanup(self) -> None:
+        self._writes.put(None)
+        self._writer.join()
+        self.flush()